@@ -5,28 +5,77 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure, PyMongoError
 from datetime import datetime, timezone
 import os
+import logging
 from dotenv import load_dotenv
-from typing import Union
+from typing import List, Union
 from pydantic import BaseModel
 
 # Load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 _client = None
 db = None
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
-if database_url and database_name:
-    _client = MongoClient(database_url)
-    db = _client[database_name]
+
+def connect():
+    """Create the Motor client (call from the app lifespan so it binds to the running loop)"""
+    global _client, db
+    if _client is None and database_url and database_name:
+        _client = AsyncIOMotorClient(
+            database_url,
+            maxPoolSize=50,
+            minPoolSize=10,
+            maxIdleTimeMS=60000,
+            waitQueueTimeoutMS=2500,
+            serverSelectionTimeoutMS=3000,
+            retryWrites=True,
+        )
+        db = _client[database_name]
+    return db
+
+
+def close():
+    """Close the Motor client and reset the module-level handle"""
+    global _client, db
+    if _client is not None:
+        _client.close()
+    _client = None
+    db = None
+
+
+async def ensure_indexes():
+    """Create indexes backing the hot query predicates (idempotent)"""
+    if db is None:
+        return
+    try:
+        await db["submission"].create_index([("user_id", 1), ("status", 1)])
+        await db["wallettransaction"].create_index([("user_id", 1), ("type", 1)])
+        await db["challenge"].create_index([("is_active", 1), ("audience", 1)])
+        await db["wallet"].create_index("user_id", unique=True)
+    except PyMongoError as e:
+        # An unreachable server must not block startup; /test reports it
+        logger.warning("Could not create indexes: %s", e)
+        return
+    try:
+        await db["submission"].create_index(
+            [("user_id", 1), ("challenge_id", 1)], unique=True
+        )
+    except OperationFailure as e:
+        # Pre-existing duplicate submissions block the unique index; keep serving
+        logger.warning("Could not create unique submission index: %s", e)
+
 
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -40,16 +89,42 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     data_dict['created_at'] = datetime.now(timezone.utc)
     data_dict['updated_at'] = datetime.now(timezone.utc)
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def create_documents(collection_name: str, items: List[Union[BaseModel, dict]]):
+    """Insert many documents with timestamps in a single round-trip"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    now = datetime.now(timezone.utc)
+    docs = []
+    for data in items:
+        data_dict = data.model_dump() if isinstance(data, BaseModel) else data.copy()
+        data_dict['created_at'] = now
+        data_dict['updated_at'] = now
+        docs.append(data_dict)
+
+    result = await db[collection_name].insert_many(docs, ordered=False)
+    return [str(i) for i in result.inserted_ids]
+
+async def get_documents(
+    collection_name: str,
+    filter_dict: dict = None,
+    limit: int = None,
+    skip: int = 0,
+    sort: list = None,
+):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
     
     cursor = db[collection_name].find(filter_dict or {})
+    if sort:
+        cursor = cursor.sort(sort)
+    if skip:
+        cursor = cursor.skip(skip)
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return await cursor.to_list(length=limit)
@@ -1,36 +1,139 @@
 import os
+import asyncio
+import logging
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
 from typing import List, Optional
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from bson import ObjectId
+from async_lru import alru_cache
+from pymongo.errors import DuplicateKeyError, PyMongoError
 
-from database import db, create_document, get_documents
-from schemas import User, Challenge, Submission, WalletTransaction
+import database
+from database import create_document, create_documents, get_documents
+from schemas import User, Challenge, Submission, Wallet, WalletTransaction
 
-app = FastAPI(title="EcoHero+ API")
+logger = logging.getLogger(__name__)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create the Motor client inside the running loop so it never binds to a stale one
+    database.connect()
+    await database.ensure_indexes()
+    try:
+        await backfill_wallets()
+    except PyMongoError as e:
+        logger.warning("Could not backfill wallets: %s", e)
+    yield
+    database.close()
+
+
+app = FastAPI(
+    title="EcoHero+ API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
+# CORS is only needed for browser clients; prefer an exact-origin allowlist
+if os.getenv("ENABLE_CORS", "").lower() in {"1", "true", "yes"}:
+    frontend_url = os.getenv("FRONTEND_URL")
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=[frontend_url] if frontend_url else ["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+
+# Environment checks reported by /test, read once at import
+_HAS_DB_URL = bool(database.database_url)
+_HAS_DB_NAME = bool(database.database_name)
+
 
 # Helpers
 class ObjectIdStr(BaseModel):
     id: str
 
 
+def require_db():
+    if database.db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    return database.db
+
+
 def to_str_id(doc):
     if doc is None:
         return None
-    d = {**doc}
-    if d.get("_id") is not None:
-        d["id"] = str(d.pop("_id"))
-    return d
+    # Driver results are fresh dicts, so rewrite the id in place
+    if doc.get("_id") is not None:
+        doc["id"] = str(doc.pop("_id"))
+    return doc
+
+
+async def sum_field(collection_name: str, match: dict, field: str) -> int:
+    """Sum a numeric field over matching documents server-side"""
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": None, "total": {"$sum": f"${field}"}}},
+    ]
+    rows = await require_db()[collection_name].aggregate(pipeline).to_list(1)
+    return rows[0]["total"] if rows else 0
+
+
+async def history_points(user_id: str) -> int:
+    """Approved submission points minus redemptions, recomputed from history"""
+    earned, redeemed = await asyncio.gather(
+        sum_field("submission", {"user_id": user_id, "status": "approved"}, "points_awarded"),
+        sum_field("wallettransaction", {"user_id": user_id, "type": "redeem"}, "points"),
+    )
+    return max(0, earned - redeemed)
+
+
+async def wallet_points(user_id: str) -> int:
+    """Current balance from the materialised wallet, or from history if it does not exist yet"""
+    wallet = await require_db()["wallet"].find_one({"user_id": user_id}, {"points": 1})
+    if wallet is None:
+        return await history_points(user_id)
+    return wallet["points"]
+
+
+async def backfill_wallets():
+    """One-off startup migration: create wallets for users that predate them"""
+    db = database.db
+    if db is None:
+        return
+    pipeline = [
+        {"$project": {"user_id": {"$toString": "$_id"}}},
+        {"$lookup": {"from": "wallet", "localField": "user_id", "foreignField": "user_id", "as": "wallet"}},
+        {"$match": {"wallet": {"$size": 0}}},
+        {"$project": {"_id": 0, "user_id": 1}},
+    ]
+    async for row in db["user"].aggregate(pipeline):
+        user_id = row["user_id"]
+        now = datetime.now(timezone.utc)
+        wallet = Wallet(user_id=user_id, points=await history_points(user_id)).model_dump()
+        await db["wallet"].update_one(
+            {"user_id": user_id},
+            {"$setOnInsert": {**wallet, "created_at": now, "updated_at": now}},
+            upsert=True,
+        )
+
+
+def wallet_summary(user_id: str, balance: int):
+    dollars = balance / 1000.0  # 1000 points = $1
+
+    return {
+        "user_id": user_id,
+        "points": balance,
+        "dollars": round(dollars, 2),
+        "can_withdraw": dollars >= 10.0,
+        "min_withdrawal_dollars": 10.0,
+    }
 
 
 @app.get("/")
@@ -39,7 +142,7 @@ def read_root():
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -49,14 +152,14 @@ def test_database():
         "collections": [],
     }
 
+    db = database.db
     try:
         if db is not None:
             response["database"] = "✅ Available"
-            response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
             response["database_name"] = db.name if hasattr(db, "name") else "Unknown"
             response["connection_status"] = "Connected"
             try:
-                response["collections"] = db.list_collection_names()
+                response["collections"] = await db.list_collection_names()
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
                 response["database"] = f"⚠️ Connected but Error: {str(e)[:50]}"
@@ -65,19 +168,18 @@ def test_database():
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
 
-    response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-    response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+    response["database_url"] = "✅ Set" if _HAS_DB_URL else "❌ Not Set"
+    response["database_name"] = "✅ Set" if _HAS_DB_NAME else "❌ Not Set"
 
     return response
 
 
 # Seed a few default challenges if none exist
 @app.post("/seed")
-def seed_challenges():
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
+async def seed_challenges():
+    db = require_db()
 
-    existing = db["challenge"].count_documents({})
+    existing = await db["challenge"].estimated_document_count()
     if existing > 0:
         return {"status": "ok", "seeded": False, "count": existing}
 
@@ -126,38 +228,52 @@ def seed_challenges():
         },
     ]
 
-    for item in defaults:
-        create_document("challenge", Challenge(**item))
+    await create_documents("challenge", [Challenge(**item) for item in defaults])
+    fetch_challenges.cache_clear()
 
     return {"status": "ok", "seeded": True, "count": len(defaults)}
 
 
-# Public endpoints
-@app.get("/challenges")
-def list_challenges(audience: Optional[str] = None):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
+# Challenges rarely change, so serve them from a short-lived per-process cache
+@alru_cache(maxsize=64, ttl=60)
+async def fetch_challenges(audience: Optional[str], skip: int, limit: int):
     query = {"is_active": True}
-    if audience in {"kid", "adult"}:
+    if audience is not None:
         query["audience"] = audience
-    docs = get_documents("challenge", query, limit=100)
+    docs = await get_documents(
+        "challenge", query, limit=limit, skip=skip, sort=[("_id", 1)]
+    )
     return [to_str_id(d) for d in docs]
 
 
-class CreateUserRequest(User):
-    pass
+# Public endpoints
+@app.get("/challenges")
+async def list_challenges(
+    audience: Optional[str] = None,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+):
+    require_db()
+    if audience not in {"kid", "adult"}:
+        audience = None
+    return await fetch_challenges(audience, skip, limit)
 
 
 @app.post("/users")
-def create_user(payload: CreateUserRequest):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
+async def create_user(payload: User):
+    db = require_db()
 
     # Simple parental approval rule: under 18 requires parent_email
     if payload.age < 18 and not payload.parent_email:
         raise HTTPException(status_code=400, detail="Parent email required for under-18 users")
 
-    new_id = create_document("user", payload)
+    new_id = await create_document("user", payload)
+    # Every user starts with an empty wallet, so /submit only ever needs a plain $inc
+    try:
+        await create_document("wallet", Wallet(user_id=new_id))
+    except Exception:
+        await db["user"].delete_one({"_id": ObjectId(new_id)})
+        raise
     return {"id": new_id}
 
 
@@ -168,16 +284,20 @@ class SubmitRequest(BaseModel):
 
 
 @app.post("/submit")
-def submit_challenge(payload: SubmitRequest):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
+async def submit_challenge(payload: SubmitRequest):
+    db = require_db()
 
     # Basic existence checks
-    try:
-        user = db["user"].find_one({"_id": ObjectId(payload.user_id)})
-        challenge = db["challenge"].find_one({"_id": ObjectId(payload.challenge_id)})
-    except Exception:
+    if not (ObjectId.is_valid(payload.user_id) and ObjectId.is_valid(payload.challenge_id)):
         raise HTTPException(status_code=400, detail="Invalid ids provided")
+    user_id = ObjectId(payload.user_id)
+    challenge_id = ObjectId(payload.challenge_id)
+
+    # Both lookups are independent, so overlap their round-trips
+    user, challenge = await asyncio.gather(
+        db["user"].find_one({"_id": user_id}, {"_id": 1}),
+        db["challenge"].find_one({"_id": challenge_id}, {"points": 1}),
+    )
 
     if not user or not challenge:
         raise HTTPException(status_code=404, detail="User or challenge not found")
@@ -193,40 +313,56 @@ def submit_challenge(payload: SubmitRequest):
         points_awarded=points,
         status="approved",
     )
-    sub_id = create_document("submission", sub)
+    try:
+        sub_id = await create_document("submission", sub)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Already submitted")
+
+    # Credit the wallet; undo the submission on failure so the two stay in step
+    try:
+        result = await db["wallet"].update_one(
+            {"user_id": payload.user_id}, {"$inc": {"points": points}}
+        )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=500, detail="Wallet not found")
+    except Exception:
+        await db["submission"].delete_one({"_id": ObjectId(sub_id)})
+        raise
 
     return {"id": sub_id, "points_awarded": points}
 
 
 @app.get("/wallet/{user_id}")
-def get_wallet(user_id: str):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
+async def get_wallet(user_id: str):
+    require_db()
 
-    try:
-        _ = ObjectId(user_id)
-    except Exception:
+    if not ObjectId.is_valid(user_id):
         raise HTTPException(status_code=400, detail="Invalid user id")
 
-    # Sum approved submissions minus redemptions
-    earned = sum(
-        d.get("points_awarded", 0)
-        for d in db["submission"].find({"user_id": user_id, "status": "approved"})
-    )
-    redeemed = sum(
-        d.get("points", 0)
-        for d in db["wallettransaction"].find({"user_id": user_id, "type": "redeem"})
-    )
-    balance = max(0, earned - redeemed)
+    balance = await wallet_points(user_id)
+    return wallet_summary(user_id, balance)
 
-    dollars = balance / 1000.0  # 1000 points = $1
+
+@app.get("/dashboard/{user_id}")
+async def get_dashboard(user_id: str, audience: Optional[str] = None):
+    require_db()
+
+    if not ObjectId.is_valid(user_id):
+        raise HTTPException(status_code=400, detail="Invalid user id")
+    if audience not in {"kid", "adult"}:
+        audience = None
+
+    # Wallet, recent history and challenges in one request, fetched concurrently
+    balance, history, challenges = await asyncio.gather(
+        wallet_points(user_id),
+        get_documents("submission", {"user_id": user_id}, limit=20, sort=[("_id", -1)]),
+        fetch_challenges(audience, 0, 20),
+    )
 
     return {
-        "user_id": user_id,
-        "points": balance,
-        "dollars": round(dollars, 2),
-        "can_withdraw": dollars >= 10.0,
-        "min_withdrawal_dollars": 10.0,
+        "wallet": wallet_summary(user_id, balance),
+        "history": [to_str_id(d) for d in history],
+        "challenges": challenges,
     }
 
 
@@ -237,13 +373,13 @@ class RedeemRequest(BaseModel):
 
 
 @app.post("/redeem")
-def redeem_points(payload: RedeemRequest):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
+async def redeem_points(payload: RedeemRequest):
+    db = require_db()
 
-    # Get wallet
-    wallet = get_wallet(payload.user_id)
-    if payload.points <= 0 or payload.points > wallet["points"]:
+    if not ObjectId.is_valid(payload.user_id):
+        raise HTTPException(status_code=400, detail="Invalid user id")
+
+    if payload.points <= 0:
         raise HTTPException(status_code=400, detail="Invalid points amount")
 
     # Enforce min withdrawal $10
@@ -251,6 +387,18 @@ def redeem_points(payload: RedeemRequest):
     if dollars < 10.0:
         raise HTTPException(status_code=400, detail="Minimum withdrawal is $10")
 
+    # Deduct atomically: the balance guard and the decrement are one operation
+    wallet = await db["wallet"].find_one_and_update(
+        {"user_id": payload.user_id, "points": {"$gte": payload.points}},
+        {"$inc": {"points": -payload.points}},
+        projection={"_id": 1},
+    )
+    if wallet is None and await db["wallet"].find_one({"user_id": payload.user_id}, {"_id": 1}) is None:
+        # Every user gets a wallet at creation (or via the startup backfill)
+        raise HTTPException(status_code=404, detail="User not found")
+    if wallet is None:
+        raise HTTPException(status_code=400, detail="Invalid points amount")
+
     # Record redemption
     txn = WalletTransaction(
         user_id=payload.user_id,
@@ -258,12 +406,26 @@ def redeem_points(payload: RedeemRequest):
         points=payload.points,
         note=("Parent-approved withdrawal" if payload.for_under18 else "Withdrawal"),
     )
-    txn_id = create_document("wallettransaction", txn)
+    try:
+        txn_id = await create_document("wallettransaction", txn)
+    except Exception:
+        await db["wallet"].update_one(
+            {"user_id": payload.user_id}, {"$inc": {"points": payload.points}}
+        )
+        raise
 
     return {"id": txn_id, "status": "pending_payout"}
 
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", 2)),
+    )
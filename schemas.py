@@ -7,7 +7,10 @@ lowercased class name. For example: User -> "user" collection.
 These schemas are used for validating data before inserting into the database.
 """
 from typing import Optional, Literal, List
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, ConfigDict, Field, EmailStr
+
+# Shared model settings: trim string input and drop unknown keys
+SCHEMA_CONFIG = ConfigDict(str_strip_whitespace=True, extra="ignore")
 
 
 class User(BaseModel):
@@ -15,6 +18,8 @@ class User(BaseModel):
     Users collection schema
     Collection: "user"
     """
+    model_config = SCHEMA_CONFIG
+
     name: str = Field(..., description="Full name")
     age: int = Field(..., ge=0, le=120, description="Age in years")
     email: Optional[EmailStr] = Field(None, description="User email (optional for kids)")
@@ -31,6 +36,8 @@ class Challenge(BaseModel):
     Eco challenges users can complete
     Collection: "challenge"
     """
+    model_config = SCHEMA_CONFIG
+
     title: str = Field(..., description="Challenge title")
     description: str = Field(..., description="What to do")
     audience: Literal["kid", "adult", "all"] = Field(
@@ -45,6 +52,8 @@ class Submission(BaseModel):
     Proof submissions for completed challenges
     Collection: "submission"
     """
+    model_config = SCHEMA_CONFIG
+
     user_id: str = Field(..., description="User id (string)")
     challenge_id: str = Field(..., description="Challenge id (string)")
     proof_url: Optional[str] = Field(
@@ -62,18 +71,33 @@ class WalletTransaction(BaseModel):
     Wallet transactions for redemptions and adjustments
     Collection: "wallettransaction"
     """
+    model_config = SCHEMA_CONFIG
+
     user_id: str = Field(..., description="User id (string)")
     type: Literal["redeem", "adjustment"] = Field(..., description="Transaction type")
     points: int = Field(..., ge=1, description="Points deducted (positive number)")
     note: Optional[str] = Field(None, description="Optional description")
 
 
+class Wallet(BaseModel):
+    """
+    Materialised point balance, one document per user
+    Collection: "wallet"
+    """
+    model_config = SCHEMA_CONFIG
+
+    user_id: str = Field(..., description="User id (string)")
+    points: int = Field(0, ge=0, description="Current spendable points")
+
+
 # Optional helper for badges (future):
 class Badge(BaseModel):
     """
     Earned badges
     Collection: "badge"
     """
+    model_config = SCHEMA_CONFIG
+
     user_id: str
     name: str
     icon: Optional[str] = None